@@ -39,8 +39,11 @@ class InferenceManager:
 
         # Optionally compile the model for optimization (torch.compile)
         if self._do_i_compile():
-            print("Using torch.compile for speedup...")
-            self.network = torch.compile(self.network)
+            # input shapes are fixed, so static shapes avoid recompilation. The inductor mode is opt-in: e.g.
+            # nnUNet_compile_mode=max-autotune benchmarks conv layouts, which can pay off for long fixed-shape runs
+            compile_mode = os.environ.get('nnUNet_compile_mode')
+            print(f"Using torch.compile (mode={compile_mode or 'default'}) for speedup...")
+            self.network = torch.compile(self.network, mode=compile_mode, dynamic=False)
 
         # Print status
         print(f"Initialized {self.model} model on device: {self.device}")
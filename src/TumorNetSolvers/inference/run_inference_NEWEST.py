@@ -43,7 +43,9 @@ def run_inference(dataset_name: str, models: list, data_folder: str, output_base
 
     # Set up the dataset and data loader
     dataset = CustomDataset(data_folder, test_keys)
-    data_loader = DataLoader(dataset, batch_size=5, shuffle=False)
+    data_loader = DataLoader(dataset, batch_size=5, shuffle=False, pin_memory=device.type == 'cuda')
+    # the param vectors are tiny, keep all of them on the device instead of copying each batch
+    parameters = {key: value.to(device) for key, value in parameters.items()}
     os.makedirs(output_base, exist_ok=True)
     # Create output directories for each model
     for model_name in models:
@@ -68,8 +70,9 @@ def run_inference(dataset_name: str, models: list, data_folder: str, output_base
         infer_manager.load_checkpoint(checkpoint_path)
         model = infer_manager.network._orig_mod.to(device).eval()
 
-        # Inference loop
-        with torch.no_grad():
+        # Inference loop. inference_mode (rather than no_grad) also drops version counter and view tracking, which
+        # is what PlainConvUNetNew.predict does, but works for all model types
+        with torch.inference_mode():
             for batch in data_loader:
                 # Check the length of the batch
                 if len(batch) == 4:
@@ -87,7 +90,7 @@ def run_inference(dataset_name: str, models: list, data_folder: str, output_base
 
                 # Gather model parameters and perform inference
                 batch_params = [parameters[key] for key in keys]
-                batch_params = torch.stack(batch_params).to(device)
+                batch_params = torch.stack(batch_params)
                 output = model(data, batch_params)
 
                 # Apply deep supervision if enabled
@@ -13,8 +13,11 @@
 Contains definitions of extended dynamic Unets to account for the integration of biophysical 
 param vector at the bottleneck
 """
+import operator
+import os
 import pydoc
 import warnings
+from functools import reduce
 from typing import Union, List, Tuple, Type
 import numpy as np
 import torch
@@ -31,6 +34,18 @@ from dynamic_network_architectures.building_blocks.residual_encoders import Resi
 from dynamic_network_architectures.building_blocks.plain_conv_encoder import PlainConvEncoder
 from batchgenerators.utilities.file_and_folder_operations import join
 
+
+def get_memory_format() -> torch.memory_format:
+    """
+    Returns the memory format used for the 3D conv tower. channels_last_3d (NDHWC) lets cuDNN dispatch straight to
+    its tensor core kernels instead of permuting internally. Set nnUNet_channels_last=false to fall back to NCDHW
+    if a layer regresses.
+    """
+    if os.environ.get('nnUNet_channels_last', 'true').lower() in ('true', '1', 't'):
+        return torch.channels_last_3d
+    return torch.contiguous_format
+
+
 class UNetDecoder(nn.Module):
     """
     Implements a U-Net decoder with support for parameter integration and deep supervision.
@@ -88,15 +103,21 @@ class UNetDecoder(nn.Module):
         transpconvs = []
         seg_layers = []
 
+        # encoder properties ordered from the bottleneck upwards: index s - 1 is the resolution below decoder stage
+        # s - 1 (features to upsample, transpconv stride), index s the resolution of its skip connection
+        rev_channels = list(reversed(encoder.output_channels))
+        rev_kernels = list(reversed(encoder.kernel_sizes))
+        rev_strides = list(reversed(encoder.strides))
+
         for s in range(1, n_stages_encoder):
             # Adjust the number of input features for the first stage
             if s == 1:
-                input_features_below = encoder.output_channels[-s] + param_dim
+                input_features_below = rev_channels[s - 1] + param_dim
             else:
-                input_features_below = encoder.output_channels[-s]
+                input_features_below = rev_channels[s - 1]
             
-            input_features_skip = encoder.output_channels[-(s + 1)]
-            stride_for_transpconv = encoder.strides[-s]
+            input_features_skip = rev_channels[s]
+            stride_for_transpconv = rev_strides[s - 1]
             
             # Define the transpose convolution layer
             transpconv_layer = transpconv_op(
@@ -108,7 +129,7 @@ class UNetDecoder(nn.Module):
             # Define the stacked convolution blocks
             conv_blocks = StackedConvBlocks(
                 n_conv_per_stage[s-1], encoder.conv_op, 2 * input_features_skip, input_features_skip,
-                encoder.kernel_sizes[-(s + 1)], 1,
+                rev_kernels[s], 1,
                 conv_bias,
                 norm_op,
                 norm_op_kwargs,
@@ -128,27 +149,48 @@ class UNetDecoder(nn.Module):
         self.stages = nn.ModuleList(stages)
         self.transpconvs = nn.ModuleList(transpconvs)
         self.seg_layers = nn.ModuleList(seg_layers)
+        self._n_stages: int = len(stages)
 
-    def forward(self, skips):
-        lres_input = skips[-1]
-        seg_outputs = []
-        for s in range(len(self.stages)):
-            x = self.transpconvs[s](lres_input)
-            x = torch.cat((x, skips[-(s+2)]), 1)
-            x = self.stages[s](x)
-            if self.deep_supervision:
-                seg_outputs.append(self.seg_layers[s](x))
-            elif s == (len(self.stages) - 1):
-                seg_outputs.append(self.seg_layers[-1](x))
-            lres_input = x
-
-        seg_outputs = seg_outputs[::-1]
-
-        if not self.deep_supervision:
-            r = seg_outputs[0]
-        else:
-            r = seg_outputs
-        return r
+    @staticmethod
+    def seg_output(seg_layer: nn.Module, x: torch.Tensor) -> torch.Tensor:
+        """
+        Applies a seg layer in fp32 even under autocast. The seg layers produce the regression output that the MSE
+        loss and the dice threshold are computed on, and bf16 would quantize it to an 8 bit mantissa.
+        """
+        with torch.autocast(x.device.type, enabled=False):
+            return seg_layer(x.float())
+
+    def forward(self, skips: List[torch.Tensor],
+                param_features: torch.Tensor) -> Union[torch.Tensor, List[torch.Tensor]]:
+        if self.deep_supervision:
+            return self.forward_train(skips, param_features)
+        return self.forward_eval(skips, param_features)
+
+    def forward_train(self, skips: List[torch.Tensor], param_features: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Deep supervision path: returns the outputs of all seg layers, highest resolution first.
+        """
+        x = self.transpconvs[0](torch.cat((skips[-1], param_features), 1))
+        seg_outputs: List[torch.Tensor] = []
+        # the transpconv of stage s + 1 is applied at the end of stage s, the last stage is handled after the loop
+        for s, (stage, seg_layer, transpconv) in enumerate(zip(self.stages[:-1], self.seg_layers[:-1],
+                                                               self.transpconvs[1:])):
+            x = stage(torch.cat((x, skips[-(s+2)]), 1))
+            seg_outputs.insert(0, self.seg_output(seg_layer, x))
+            x = transpconv(x)
+        x = self.stages[-1](torch.cat((x, skips[0]), 1))
+        seg_outputs.insert(0, self.seg_output(self.seg_layers[-1], x))
+        return seg_outputs
+
+    def forward_eval(self, skips: List[torch.Tensor], param_features: torch.Tensor) -> torch.Tensor:
+        """
+        Returns only the full resolution output of the last seg layer.
+        """
+        x = self.transpconvs[0](torch.cat((skips[-1], param_features), 1))
+        for s, (stage, transpconv) in enumerate(zip(self.stages[:-1], self.transpconvs[1:])):
+            x = transpconv(stage(torch.cat((x, skips[-(s+2)]), 1)))
+        # only the last seg layer is evaluated, so the tail can be fused without dead seg_layer compute
+        return self.seg_output(self.seg_layers[-1], self.stages[-1](torch.cat((x, skips[0]), 1)))
 
     def compute_conv_feature_map_size(self, input_size):
         skip_sizes = []
@@ -156,14 +198,16 @@ class UNetDecoder(nn.Module):
             skip_sizes.append([i // j for i, j in zip(input_size, self.encoder.strides[s])])
             input_size = skip_sizes[-1]
 
-        assert len(skip_sizes) == len(self.stages)
+        assert len(skip_sizes) == self._n_stages
 
         output = np.int64(0)
-        for s in range(len(self.stages)):
+        for s in range(self._n_stages):
+            # plain int products, np.prod dispatch is far slower for a handful of elements
+            n_voxels = reduce(operator.mul, skip_sizes[-(s+1)], 1)
             output += self.stages[s].compute_conv_feature_map_size(skip_sizes[-(s+1)])
-            output += np.prod([self.encoder.output_channels[-(s+2)], *skip_sizes[-(s+1)]], dtype=np.int64)
-            if self.deep_supervision or (s == (len(self.stages) - 1)):
-                output += np.prod([self.num_classes, *skip_sizes[-(s+1)]], dtype=np.int64)
+            output += self.encoder.output_channels[-(s+2)] * n_voxels
+            if self.deep_supervision or (s == (self._n_stages - 1)):
+                output += self.num_classes * n_voxels
         return output
 
 
@@ -187,6 +231,10 @@ class PlainConvUNetNew(nn.Module):
         deep_supervision: Enables deep supervision.
         nonlin_first: Non-linearity is applied before normalization.
         param_dim: Dimension of parameter vector.
+        inputs_shape: Shape of the network input, used to derive the bottleneck size.
+        param_projection: How the param vector is projected onto the bottleneck. 'full' uses a dense Linear layer,
+            'separable' a param_dim x param_dim mixing followed by a learned per-channel spatial template. Selected by
+            the param_projection entry of the plans' arch_kwargs.
     """
     def __init__(self,
                  input_channels: int,
@@ -208,7 +256,8 @@ class PlainConvUNetNew(nn.Module):
                  deep_supervision: bool = False,
                  nonlin_first: bool = False,
                  param_dim: int =5,
-                 inputs_shape: torch.Size = None
+                 inputs_shape: torch.Size = None,
+                 param_projection: str = 'full'
                  ):
         super().__init__()
         if isinstance(n_conv_per_stage, int):
@@ -228,41 +277,115 @@ class PlainConvUNetNew(nn.Module):
             latent_spatial_size = [i // s for i, s in zip(latent_spatial_size, stride)]
         self.latent_space_sz = latent_spatial_size[0]
 
-        self.param_fc = nn.Linear(
-            in_features=param_dim,
-            out_features=self.latent_space_sz ** 3 * param_dim
-        )
+        self.param_projection = param_projection
+        if param_projection == 'full':
+            self.param_fc = nn.Linear(
+                in_features=param_dim,
+                out_features=self.latent_space_sz ** 3 * param_dim
+            )
+        elif param_projection == 'separable':
+            # S^3 times fewer weights than param_fc: each output channel is a learned template scaled per sample.
+            # The template carries a leading batch axis so that it is converted to the network memory format below
+            # and the broadcast product comes out in that layout directly
+            self.param_mix = nn.Linear(param_dim, param_dim)
+            self.param_template = nn.Parameter(
+                torch.empty(1, param_dim, self.latent_space_sz, self.latent_space_sz, self.latent_space_sz)
+            )
+            self.reset_parameters()
+        else:
+            raise ValueError(f"Unsupported param_projection: {param_projection}")
 
         self.decoder = UNetDecoder(self.encoder, num_classes, n_conv_per_stage_decoder, deep_supervision,
                                    nonlin_first=nonlin_first, param_dim=self.param_dim)
 
-    def integrateParams(self, param, latent_space_sz, skips, batch_size):
-        param = param.to(skips[-1].device)  # Ensure param is on the same device as the skips
-        self.param_fc = self.param_fc.to(skips[-1].device)
-        p = self.param_fc(param).view(batch_size, param.size(1), latent_space_sz, latent_space_sz, latent_space_sz)
-        # Concatenate along channel dimension
-        z_cat = torch.cat((skips[-1], p), dim=1)
-        skips[-1] = z_cat
+        # channels_last_3d only applies to 5D tensors; 2D configurations keep the default layout
+        self.memory_format = get_memory_format() if convert_conv_op_to_dim(conv_op) == 3 else torch.contiguous_format
+        self.to(memory_format=self.memory_format)
+        self._bottleneck_layout_checked = False
+
+    def project_params(self, param: torch.Tensor, latent_space_sz: int, batch_size: int) -> torch.Tensor:
+        """
+        Returns the param features at bottleneck resolution, laid out in the memory format of the conv tower so that
+        concatenating them with the bottleneck in the decoder does not need an implicit layout conversion.
+
+        The projection conditions the whole decoder on a handful of values, so it runs outside of autocast in the
+        dtype its weights are stored in: fp32 by default. param_fc may be stored in a lower precision on purpose
+        (e.g. network.param_fc.to(torch.bfloat16) after loading a checkpoint for inference) to halve the bandwidth
+        spent on its S^3 * param_dim x param_dim weight; inputs and outputs are then cast on the fly.
+        """
+        with torch.autocast(param.device.type, enabled=False):
+            if self.param_projection == 'separable':
+                p = self.param_mix(param.to(self.param_mix.weight.dtype))[:, :, None, None, None] * self.param_template
+            else:
+                p = self.param_fc(param.to(self.param_fc.weight.dtype))
+                p = p.view(batch_size, param.size(1), latent_space_sz, latent_space_sz, latent_space_sz)
+            p = p.to(param.dtype)
+        # no-op for the separable projection; a copy of only B * param_dim * S^3 values for param_fc
+        return p.contiguous(memory_format=self.memory_format)
+
+    def integrateParams(self, param: torch.Tensor, latent_space_sz: int, batch_size: int,
+                        device: torch.device) -> torch.Tensor:
+        """
+        Projects the param vector to bottleneck resolution. The decoder concatenates it with the bottleneck before
+        the first transposed conv.
+        """
+        # callers move param to the network device together with the input batch (non_blocking, from pinned memory),
+        # a transfer here would be synchronous and sit in the middle of the forward pass
+        assert param.device == device, f"param is on {param.device} but the network runs on {device}"
+        return self.project_params(param, latent_space_sz, batch_size)
 
     def forward(self, x, param):
-        batch_size = x.size(0)
+        batch_size = x.shape[0]
+        x = x.contiguous(memory_format=self.memory_format)
         skips = self.encoder(x)
-        latent_space_sz = skips[-1].shape[-1]
-        self.integrateParams(param, latent_space_sz, skips, batch_size)
-        return self.decoder(skips)
+        bottleneck = skips[-1]
+        if not self._bottleneck_layout_checked and not torch.compiler.is_compiling():
+            # a layer in the encoder that drops channels_last_3d silently costs a layout conversion in every stage
+            # after it, so report it once instead of failing the forward pass
+            self._bottleneck_layout_checked = True
+            if not bottleneck.is_contiguous(memory_format=self.memory_format):
+                warnings.warn(f"The encoder returned its bottleneck in a different memory format than "
+                              f"{self.memory_format}; some encoder layer does not preserve it.")
+        param_features = self.integrateParams(param, bottleneck.shape[-1], batch_size, bottleneck.device)
+        return self.decoder(skips, param_features)
+
+    @torch.inference_mode()
+    def predict(self, x, param):
+        """
+        Inference entry point: runs forward without autograd bookkeeping (version counters, view tracking). External
+        inference code should call this instead of forward. Outputs are inference tensors and cannot be used in
+        autograd, so gradient based uses such as fitting the param vector must call forward.
+        """
+        return self.forward(x, param)
 
     def compute_conv_feature_map_size(self, input_size):
         assert len(input_size) == convert_conv_op_to_dim(self.encoder.conv_op)
         return self.encoder.compute_conv_feature_map_size(input_size) + self.decoder.compute_conv_feature_map_size(input_size)
 
+    def reset_parameters(self):
+        if self.param_projection == 'separable':
+            nn.init.normal_(self.param_template, std=0.02)
+
     @staticmethod
     def initialize(module):
         InitWeights_He(1e-2)(module)
+        # networks built on the meta device never ran the default init of the layers InitWeights_He does not cover
+        if not isinstance(module, _ConvNd) and hasattr(module, 'reset_parameters'):
+            module.reset_parameters()
 
 
 
 def get_network_from_plans_new(arch_class_name, arch_kwargs, arch_kwargs_req_import, input_channels, output_channels, inputs_shape,
                            allow_init=True, deep_supervision: Union[bool, None] = None):
+    """
+    Builds the network described by the plans. The network is returned unwrapped and on CPU; for multi-GPU training
+    launch with torchrun and wrap it in DistributedDataParallel after moving it to the local device (the Trainer
+    does this when a process group is initialized).
+
+    With allow_init=False the network is left on the meta device: it holds no weight memory and only supports
+    shape queries such as compute_conv_feature_map_size. To load a checkpoint into it, materialize it first with
+    network.to_empty(device=...) or use load_state_dict(..., assign=True).
+    """
     architecture_kwargs = dict(**arch_kwargs)
     architecture_classes = {
     'PlainConvUnetNew': PlainConvUNetNew
@@ -279,15 +402,20 @@ def get_network_from_plans_new(arch_class_name, arch_kwargs, arch_kwargs_req_imp
     
     
 
-    network = nw_class(
-        input_channels=input_channels,
-        num_classes=output_channels,
-        inputs_shape=inputs_shape,
-        **architecture_kwargs
-    )
+    # build on the meta device so the default init of every layer is skipped, weights are then initialized only once
+    # by network.initialize
+    with torch.device('meta'):
+        network = nw_class(
+            input_channels=input_channels,
+            num_classes=output_channels,
+            inputs_shape=inputs_shape,
+            **architecture_kwargs
+        )
 
-    if hasattr(network, 'initialize') and allow_init:
-        network.apply(network.initialize)
+    if allow_init:
+        network = network.to_empty(device='cpu')
+        if hasattr(network, 'initialize'):
+            network.apply(network.initialize)
 
     return network
 
@@ -69,6 +69,9 @@ class ExperimentPlanner(object):
         self.UNet_min_batch_size = 2
         self.UNet_max_features_2d = 512
         self.UNet_max_features_3d = 320
+        # how PlainConvUNetNew projects the param vector onto the bottleneck: 'full' or 'separable' (S^3 times fewer
+        # weights for the projection)
+        self.UNet_param_projection = 'full'
         self.max_dataset_covered = 0.05 # we limit the batch size so that no more than 5% of the dataset can be seen
         # in a single forward/backward pass
 
@@ -301,6 +304,7 @@ class ExperimentPlanner(object):
                 'dropout_op_kwargs': None,
                 'nonlin': 'torch.nn.LeakyReLU',
                 'nonlin_kwargs': {'inplace': True},
+                'param_projection': self.UNet_param_projection,
             },
             '_kw_requires_import': ('conv_op', 'norm_op', 'dropout_op', 'nonlin'),
         }
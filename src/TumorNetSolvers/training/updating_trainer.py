@@ -152,7 +152,15 @@ class Trainer(object):
 
 
         self.optimizer = self.lr_scheduler = None  # -> self.initialize
-        self.grad_scaler = GradScaler() if self.device.type == 'cuda' else None
+        # bf16 runs the conv tower on tensor cores at the same speed as fp16 but keeps the fp32 exponent range, so no
+        # loss scaling is needed. Pre-Ampere GPUs (compute capability < 8) only emulate bf16 and fall back to fp16 +
+        # GradScaler. torch.cuda.is_bf16_supported() counts emulation as support, so the capability is checked directly.
+        # Only PlainConvUNetNew keeps its param projection and seg layers in fp32; the other models would regress their
+        # output in bf16, so they stay on fp16
+        self.autocast_dtype = torch.bfloat16 \
+            if self.model == "nnUnet" and self.device.type == 'cuda' \
+            and torch.cuda.get_device_capability(self.device)[0] >= 8 else torch.float16
+        self.grad_scaler = GradScaler() if self.device.type == 'cuda' and self.autocast_dtype == torch.float16 else None
         self.loss = None  # -> self.initialize
 
         # logging
@@ -203,14 +211,21 @@ class Trainer(object):
 
             # compile network for free speedup
             if self._do_i_compile():
-                self.print_to_log_file('Using torch.compile...')
-                self.network = torch.compile(self.network)
+                # patch size and batch size are fixed, so static shapes avoid recompilation. The inductor mode is
+                # opt-in through nnUNet_compile_mode (e.g. reduce-overhead for CUDA graphs on a single GPU)
+                compile_mode = os.environ.get('nnUNet_compile_mode')
+                self.print_to_log_file(f"Using torch.compile (mode={compile_mode or 'default'})...")
+                self.network = torch.compile(self.network, mode=compile_mode, dynamic=False)
 
             self.optimizer, self.lr_scheduler = self.configure_optimizers()
             # if ddp, wrap in DDP wrapper
             if self.is_ddp:
                 self.network = torch.nn.SyncBatchNorm.convert_sync_batchnorm(self.network)
-                self.network = DDP(self.network, device_ids=[self.local_rank])
+                # a PlainConvUNetNew decoder without deep supervision only gives gradients to its last seg layer
+                mod = self.network._orig_mod if isinstance(self.network, OptimizedModule) else self.network
+                has_unused_seg_layers = self.model == "nnUnet" and not mod.decoder.deep_supervision
+                self.network = DDP(self.network, device_ids=[self.local_rank],
+                                   find_unused_parameters=has_unused_seg_layers)
             self.loss = self._build_loss()
 
             self.was_initialized = True
@@ -788,7 +803,8 @@ class Trainer(object):
             target = self.mask(target).to(self.device, non_blocking=True)
 
         self.optimizer.zero_grad(set_to_none=True)
-        with autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+        with autocast(self.device.type, dtype=self.autocast_dtype, enabled=True) \
+                if self.device.type == 'cuda' else dummy_context():
             output = self.network(data, param)
             # del data
             l = self.loss(output, target)
@@ -863,7 +879,8 @@ class Trainer(object):
             target = self.mask(target).to(self.device, non_blocking=True)
         param = param.to(self.device, non_blocking=True)
 
-        with autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+        with autocast(self.device.type, dtype=self.autocast_dtype, enabled=True) \
+                if self.device.type == 'cuda' else dummy_context():
             output = self.network(data, param)
             del data, param
             l = self.loss(output, target)